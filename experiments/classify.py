@@ -65,6 +65,9 @@ def go(arg):
     else:
         mx = arg.max_length
 
+    # allow TF32 tensor cores for float32 matmuls (no effect on CPU)
+    torch.set_float32_matmul_precision("high")
+
     # create the model
     model = former.CTransformer(
         emb=arg.embedding_size,
@@ -74,6 +77,7 @@ def go(arg):
         num_tokens=arg.vocab_size,
         num_classes=NUM_CLS,
         max_pool=arg.max_pool,
+        compile=arg.compile,
     )
     if torch.cuda.is_available():
         model.cuda()
@@ -101,8 +105,8 @@ def go(arg):
 
             if input.size(1) > mx:
                 input = input[:, :mx]
-            out = model(input)
-            loss = F.nll_loss(out, label)
+            out = model(input, logits=True)
+            loss = F.cross_entropy(out, label)
 
             loss.backward()
 
@@ -268,6 +272,13 @@ if __name__ == "__main__":
         type=float,
     )
 
+    parser.add_argument(
+        "--compile",
+        dest="compile",
+        help="Compile the transformer blocks with torch.compile.",
+        action="store_true",
+    )
+
     options = parser.parse_args()
 
     print("OPTIONS ", options)
@@ -82,6 +82,9 @@ def go(arg):
         else (data_train, data_val)
     )
 
+    # allow TF32 tensor cores for float32 matmuls (no effect on CPU)
+    torch.set_float32_matmul_precision("high")
+
     # create the model
     model = GTransformer(
         emb=arg.embedding_size,
@@ -89,6 +92,7 @@ def go(arg):
         depth=arg.depth,
         seq_length=arg.context,
         num_tokens=NUM_TOKENS,
+        compile=arg.compile,
     )
     if torch.cuda.is_available():
         model.cuda()
@@ -132,9 +136,11 @@ def go(arg):
             source, target = source.cuda(), target.cuda()
         source, target = Variable(source), Variable(target)
 
-        output = model(source)
+        output = model(source, logits=True)
 
-        loss = F.nll_loss(output.transpose(2, 1), target, reduction="mean")
+        loss = F.cross_entropy(
+            output.transpose(2, 1), target, reduction="mean"
+        )
         tbw.add_scalar(
             "transformer/train-loss",
             float(loss.item()) * LOG2E,
@@ -385,6 +391,13 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "--compile",
+        dest="compile",
+        help="Compile the transformer blocks with torch.compile.",
+        action="store_true",
+    )
+
     options = parser.parse_args()
 
     print("OPTIONS ", options)
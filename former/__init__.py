@@ -1,3 +1,3 @@
-from .modules import SelfAttention, TransformerBlock
+from .modules import SelfAttention, TransformerBlock, TransformerStack
 
 from .transformers import GTransformer, CTransformer
@@ -1,110 +1,141 @@
 from former import util
-from .util import mask_
-
 import torch
+import torch.utils.checkpoint
 from torch import nn
 import torch.nn.functional as F
 
-# import random,
-import math
-
 
 class SelfAttention(nn.Module):
-    def __init__(self, emb, heads=8, mask=False):
+    def __init__(self, emb, heads=8, mask=False, kv_heads=None):
         """
 
         :param emb:
         :param heads:
         :param mask:
+        :param kv_heads: Nr. of key/value heads. Each is shared by a group of
+            heads // kv_heads query heads (grouped-query attention, or
+            multi-query attention for kv_heads=1). Defaults to heads.
         """
 
         super().__init__()
 
+        assert (
+            emb % heads == 0
+        ), f"Embedding dim ({emb}) should be divisible by nr. of heads ({heads})"
+
+        kv_heads = heads if kv_heads is None else kv_heads
+        assert (
+            heads % kv_heads == 0
+        ), f"Nr. of heads ({heads}) should be divisible by nr. of key/value heads ({kv_heads})"
+
         self.emb = emb
         self.heads = heads
+        self.kv_heads = kv_heads
+        self.head_dim = emb // heads
         self.mask = mask
 
-        self.tokeys = nn.Linear(emb, emb * heads, bias=False)
-        self.toqueries = nn.Linear(emb, emb * heads, bias=False)
-        self.tovalues = nn.Linear(emb, emb * heads, bias=False)
+        # each head attends over a slice of size emb // heads, so the total
+        # projected dimension equals emb (for kv_heads=heads). Queries, keys
+        # and values are computed by a single projection (one matmul instead
+        # of three).
+        self.toqkv = nn.Linear(
+            emb, emb + 2 * kv_heads * self.head_dim, bias=False
+        )
 
-        self.unifyheads = nn.Linear(heads * emb, emb)
+        self.unifyheads = nn.Linear(emb, emb)
 
-    def forward(self, x):
+    def forward(self, x, past_kv=None, use_cache=False):
+        """
+        :param x: A batch of (new) input vectors, of size (b, t, emb).
+        :param past_kv: Optional tuple of cached keys and values for the
+            preceding positions, as returned by a previous call with
+            use_cache=True.
+        :param use_cache: If true, return a tuple (output, (keys, values)) so
+            the keys and values can be passed back in as past_kv.
+        :return:
+        """
 
         b, t, e = x.size()
         h = self.heads
+        k = self.kv_heads
+        s = self.head_dim
         assert (
             e == self.emb
         ), f"Input embedding dim ({e}) should match layer embedding dim ({self.emb})"
 
-        keys = self.tokeys(x).view(b, t, h, e)
-        queries = self.toqueries(x).view(b, t, h, e)
-        values = self.tovalues(x).view(b, t, h, e)
+        # - keep heads as a separate dimension: (b, h, t, s) for the queries
+        #   and (b, k, t, s) for the keys and values
+        qkv = self.toqkv(x)
+        queries = qkv[..., :e].view(b, t, h, s).transpose(1, 2)
+        kv = qkv[..., e:].view(b, t, 2, k, s).permute(2, 0, 3, 1, 4)
+        keys, values = kv[0], kv[1]
 
-        # compute scaled dot-product self-attention
+        if past_kv is not None:
+            # - prepend the cached keys and values of the earlier positions
+            past_keys, past_values = past_kv
+            keys = torch.cat([past_keys, keys], dim=2)
+            values = torch.cat([past_values, values], dim=2)
+
+        if use_cache:
+            # cache before sharing the heads, so the cache stays small
+            cache = (keys, values)
 
-        # - fold heads into the batch dimension
-        keys = keys.transpose(1, 2).contiguous().view(b * h, t, e)
-        queries = queries.transpose(1, 2).contiguous().view(b * h, t, e)
-        values = values.transpose(1, 2).contiguous().view(b * h, t, e)
-
-        # replaced original code that divides both queries and keys
-        # doing it once is enough and produces the same results since
-        # they are multiplied together.
-        queries = queries / math.sqrt(e)
-        # queries = queries / math.pow(e, 0.25)
-        # keys = keys / math.pow(e, 0.25)
-
-        # Instead of dividing the dot products by sqrt(e), we scale the keys
-        # and values.
-        # This should be more memory efficient
-        # see https://github.com/pbloem/former/issues/5 for explanation on
-        # when this would be more memory efficient - i.e. when t >> e
-
-        # - get dot product of queries and keys, and scale
-        dot = torch.bmm(queries, keys.transpose(1, 2))
-
-        assert dot.size() == (
-            b * h,
-            t,
-            t,
-        ), f"Matrix has size {dot.size()}, expected {(b*h, t, t)}."
-
-        if self.mask:
-            # mask out the upper half of the dot matrix, excluding the diagonal
-            mask_(dot, maskval=float("-inf"), mask_diagonal=False)
-
-        dot = F.softmax(dot, dim=2)
-        # dot now has row-wise self-attention probabilities
-
-        # assert not util.contains_nan(dot[:, 1:, :])
-        # assert not torch.isnan(dot[:, 1:, :]).any()
-        # only the forst row may contain nan
-
-        # if self.mask == "first":
-        #     dot = dot.clone()
-        #     dot[:, :1, :] = 0.0
-        #     # The first row of the first attention matrix is entirely masked
-        #     # out, so the softmax operation results in a division by zero.
-        #     # We set this row to zero by hand to get rid of the NaNs
-
-        # apply the self attention to the values
-        out = torch.bmm(dot, values).view(b, h, t, e)
+        # - total nr. of positions attended over
+        tk = keys.size(2)
+
+        if k != h:
+            # - share each key/value head across its group of query heads
+            keys = keys.repeat_interleave(h // k, dim=1)
+            values = values.repeat_interleave(h // k, dim=1)
+
+        # compute scaled dot-product self-attention
+        # SDPA scales by 1/sqrt(s) and applies the causal mask itself, and
+        # dispatches to a fused (flash / memory efficient) kernel where
+        # available, so the (t, t) matrix of dot products is never
+        # materialized.
+        if not self.mask or t == 1:
+            # a single new position may attend over everything before it
+            out = F.scaled_dot_product_attention(queries, keys, values)
+        elif t == tk:
+            out = F.scaled_dot_product_attention(
+                queries, keys, values, is_causal=True
+            )
+        else:
+            # several new positions after cached ones: query i sits at
+            # position tk - t + i, so the causal mask is offset accordingly.
+            # (is_causal aligns the mask to the top left instead.)
+            mask = torch.ones(t, tk, dtype=torch.bool, device=x.device)
+            mask = mask.tril(diagonal=tk - t)
+            out = F.scaled_dot_product_attention(
+                queries, keys, values, attn_mask=mask
+            )
 
         # swap h, t back, unify heads
-        out = out.transpose(1, 2).contiguous().view(b, t, h * e)
+        out = out.transpose(1, 2).reshape(b, t, h * s)
+        out = self.unifyheads(out)
 
-        return self.unifyheads(out)
+        if use_cache:
+            return out, cache
+
+        return out
 
 
 class TransformerBlock(nn.Module):
     def __init__(
-        self, emb, heads, mask, seq_length, ff_hidden_mult=4, dropout=0.0
+        self,
+        emb,
+        heads,
+        mask,
+        seq_length,
+        ff_hidden_mult=4,
+        dropout=0.0,
+        kv_heads=None,
     ):
         super().__init__()
 
-        self.attention = SelfAttention(emb, heads=heads, mask=mask)
+        self.attention = SelfAttention(
+            emb, heads=heads, mask=mask, kv_heads=kv_heads
+        )
         self.mask = mask
 
         self.norm1 = nn.LayerNorm(emb)
@@ -112,24 +143,77 @@ class TransformerBlock(nn.Module):
 
         self.ff = nn.Sequential(
             nn.Linear(emb, ff_hidden_mult * emb),
-            nn.ReLU(),
+            nn.GELU(approximate="tanh"),
             nn.Linear(ff_hidden_mult * emb, emb),
         )
 
-        self.do = nn.Dropout(dropout)
+        # skip the dropout kernel entirely when it would be a no-op
+        self.do = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
 
-    def forward(self, x):
+    def forward(self, x, past_kv=None, use_cache=False):
+
+        # pre-norm: normalize the input of each sublayer and keep the
+        # residual stream itself un-normalized. The models apply a final
+        # LayerNorm after the last block.
+        attended = self.attention(
+            self.norm1(x), past_kv=past_kv, use_cache=use_cache
+        )
+        if use_cache:
+            attended, cache = attended
 
-        attended = self.attention(x)
+        x = x + self.do(attended)
 
-        x = self.norm1(attended + x)
+        x = x + self.do(self.ff(self.norm2(x)))
+
+        if use_cache:
+            return x, cache
+
+        return x
 
-        x = self.do(x)
 
-        fedforward = self.ff(x)
+class TransformerStack(nn.ModuleList):
+    """
+    A stack of transformer blocks, applied one after the other.
+    """
 
-        x = self.norm2(fedforward + x)
+    def __init__(self, blocks, checkpoint=False):
+        """
+        :param blocks: The transformer blocks.
+        :param checkpoint: If true, don't store the activations inside each
+            block during training, but recompute them in the backward pass.
+            This saves memory for long sequences at the cost of compute.
+        """
+        super().__init__(blocks)
+
+        self.checkpoint = checkpoint
+
+    def forward(self, x, past_kvs=None, use_cache=False):
+        """
+        :param x: A batch of input vectors, of size (b, t, emb).
+        :param past_kvs: Optional list with the cached keys and values of
+            each block, as returned by a previous call with use_cache=True.
+        :param use_cache: If true, return a tuple (output, kvs) with the keys
+            and values of each block, to be passed back in as past_kvs.
+        :return:
+        """
 
-        x = self.do(x)
+        # a plain loop rather than nn.Sequential, which torch.compile can
+        # capture as a single graph
+        if use_cache or past_kvs is not None:
+            kvs = []
+            for i, block in enumerate(self):
+                past_kv = None if past_kvs is None else past_kvs[i]
+                x, kv = block(x, past_kv=past_kv, use_cache=True)
+                kvs.append(kv)
+
+            return (x, kvs) if use_cache else x
+
+        for block in self:
+            if self.checkpoint and self.training and torch.is_grad_enabled():
+                x = torch.utils.checkpoint.checkpoint(
+                    block, x, use_reentrant=False
+                )
+            else:
+                x = block(x)
 
         return x
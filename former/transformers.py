@@ -2,9 +2,9 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
-from .modules import TransformerBlock
+from .modules import TransformerBlock, TransformerStack
 
-from .util import d
+from .util import autocast
 
 
 class GTransformer(nn.Module):
@@ -12,7 +12,18 @@ class GTransformer(nn.Module):
     Transformer for generating text (character by character).
     """
 
-    def __init__(self, emb, heads, depth, seq_length, num_tokens):
+    def __init__(
+        self,
+        emb,
+        heads,
+        depth,
+        seq_length,
+        num_tokens,
+        compile=False,
+        autocast_dtype=None,
+        activation_checkpoint=False,
+        kv_heads=None,
+    ):
         super().__init__()
 
         self.num_tokens = num_tokens
@@ -22,38 +33,77 @@ class GTransformer(nn.Module):
         self.pos_embedding = nn.Embedding(
             embedding_dim=emb, num_embeddings=seq_length
         )
+        # position indices, so they aren't recreated every forward pass
+        self.register_buffer(
+            "pos_ids", torch.arange(seq_length), persistent=False
+        )
 
         tblocks = []
         for i in range(depth):
             tblocks.append(
                 TransformerBlock(
-                    emb=emb, heads=heads, seq_length=seq_length, mask=True
+                    emb=emb,
+                    heads=heads,
+                    seq_length=seq_length,
+                    mask=True,
+                    kv_heads=kv_heads,
                 )
             )
 
-        self.tblocks = nn.Sequential(*tblocks)
+        self.tblocks = TransformerStack(
+            tblocks, checkpoint=activation_checkpoint
+        )
+        if compile:
+            # in place, so parameter names in the state dict are unchanged
+            self.tblocks.compile(fullgraph=True)
+        self.autocast_dtype = autocast_dtype
+
+        # the blocks are pre-norm, so normalize the output of the last one
+        self.norm = nn.LayerNorm(emb)
 
         self.toprobs = nn.Linear(emb, num_tokens)
 
-    def forward(self, x):
+    def forward(self, x, logits=False, past_kvs=None, use_cache=False):
         """
         :param x: A batch by sequence length integer tensor of token indices.
+        :param logits: If true, return the unnormalized logits instead. Use this with
+                       F.cross_entropy for training, which fuses the log-softmax into the loss.
+        :param past_kvs: Cached keys and values of the preceding tokens, as returned by a previous
+                         call with use_cache=True. x should then contain only the new tokens.
+        :param use_cache: If true, return a tuple (output, kvs) with the keys and values of all
+                          tokens seen so far, to be passed back in as past_kvs.
         :return: predicted log-probability vectors for each token based on the preceding tokens.
         """
         tokens = self.token_embedding(x)
         b, t, e = tokens.size()
 
-        # original device is set to d()
-        positions = self.pos_embedding(torch.arange(t, device=tokens.device))[
-            None, :, :
-        ].expand(b, t, e)
+        # - nr. of preceding tokens in the cache
+        p = 0 if past_kvs is None else past_kvs[0][0].size(2)
+        assert p + t <= self.pos_ids.size(0), (
+            f"cache + new tokens ({p}+{t}) exceeds seq_length "
+            f"({self.pos_ids.size(0)})"
+        )
+
+        # (1, t, e), broadcast over the batch in the addition below
+        positions = self.pos_embedding(self.pos_ids[p : p + t])[None, :, :]
         x = tokens + positions
 
-        x = self.tblocks(x)
+        with autocast(x, self.autocast_dtype):
+            x = self.tblocks(x, past_kvs=past_kvs, use_cache=use_cache)
+            if use_cache:
+                x, kvs = x
+            x = self.norm(x)
+        x = x.to(self.toprobs.weight.dtype)
 
-        x = self.toprobs(x.view(b * t, e)).view(b, t, self.num_tokens)
+        x = self.toprobs(x)
+
+        if not logits:
+            x = F.log_softmax(x, dim=2)
 
-        return F.log_softmax(x, dim=2)
+        if use_cache:
+            return x, kvs
+
+        return x
 
 
 class CTransformer(nn.Module):
@@ -71,6 +121,10 @@ class CTransformer(nn.Module):
         num_classes,
         max_pool=True,
         dropout=0.0,
+        compile=False,
+        autocast_dtype=None,
+        activation_checkpoint=False,
+        kv_heads=None,
     ):
         """
         :param emb: Embedding dimension
@@ -81,6 +135,13 @@ class CTransformer(nn.Module):
         :param num_classes: Number of classes.
         :param max_pool: If true, use global max pooling in the last layer. If false, use global
                          average pooling.
+        :param compile: If true, compile the transformer blocks with torch.compile.
+        :param autocast_dtype: If given (e.g. torch.bfloat16), run the transformer blocks under
+                               autocast in this dtype. The output layer always runs in full precision.
+        :param activation_checkpoint: If true, recompute the activations of each transformer block in
+                                      the backward pass instead of storing them.
+        :param kv_heads: Nr. of key/value heads, shared by groups of query heads (grouped-query
+                         attention). Defaults to heads.
         """
         super().__init__()
 
@@ -92,6 +153,10 @@ class CTransformer(nn.Module):
         self.pos_embedding = nn.Embedding(
             embedding_dim=emb, num_embeddings=seq_length
         )
+        # position indices, so they aren't recreated every forward pass
+        self.register_buffer(
+            "pos_ids", torch.arange(seq_length), persistent=False
+        )
 
         tblocks = []
         for i in range(depth):
@@ -102,37 +167,54 @@ class CTransformer(nn.Module):
                     seq_length=seq_length,
                     mask=False,
                     dropout=dropout,
+                    kv_heads=kv_heads,
                 )
             )
 
-        self.tblocks = nn.Sequential(*tblocks)
+        self.tblocks = TransformerStack(
+            tblocks, checkpoint=activation_checkpoint
+        )
+        if compile:
+            # in place, so parameter names in the state dict are unchanged
+            self.tblocks.compile(fullgraph=True)
+        self.autocast_dtype = autocast_dtype
+
+        # the blocks are pre-norm, so normalize the output of the last one
+        self.norm = nn.LayerNorm(emb)
 
         self.toprobs = nn.Linear(emb, num_classes)
 
-        self.do = nn.Dropout(dropout)
+        # skip the dropout kernel entirely when it would be a no-op
+        self.do = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
 
-    def forward(self, x):
+    def forward(self, x, logits=False):
         """
         :param x: A batch by sequence length integer tensor of token indices.
+        :param logits: If true, return the unnormalized logits instead. Use this with
+                       F.cross_entropy for training, which fuses the log-softmax into the loss.
         :return: predicted log-probability vectors for each token based on the preceding tokens.
         """
         tokens = self.token_embedding(x)
         b, t, e = tokens.size()
 
-        positions = self.pos_embedding(torch.arange(t, device=tokens.device))[
-            None, :, :
-        ].expand(b, t, e)
+        # (1, t, e), broadcast over the batch in the addition below
+        positions = self.pos_embedding(self.pos_ids[:t])[None, :, :]
         x = tokens + positions
         x = self.do(x)
 
-        x = self.tblocks(x)
+        with autocast(x, self.autocast_dtype):
+            x = self.norm(self.tblocks(x))
+        x = x.to(self.toprobs.weight.dtype)
 
         x = (
-            x.max(dim=1)[0] if self.max_pool else x.mean(dim=1)
+            x.amax(dim=1) if self.max_pool else x.mean(dim=1)
         )  # pool over the time dimension
 
         x = self.toprobs(x)
 
+        if logits:
+            return x
+
         return F.log_softmax(x, dim=1)
 
 
@@ -152,6 +234,10 @@ class TSTransformer(nn.Module):
         num_classes: int,
         max_pool: bool = True,
         dropout: float = 0.0,
+        compile: bool = False,
+        autocast_dtype: torch.dtype = None,
+        activation_checkpoint: bool = False,
+        kv_heads: int = None,
     ):
         """
         A time series transfomrmer that can handle both numerical and
@@ -166,6 +252,16 @@ class TSTransformer(nn.Module):
         :param max_pool: If true, use global max pooling in the last layer.
             If false, use global
                          average pooling.
+        :param compile: If true, compile the transformer blocks with
+            torch.compile.
+        :param autocast_dtype: If given (e.g. torch.bfloat16), run the
+            transformer blocks under autocast in this dtype. Pooling and the
+            output layer always run in full precision.
+        :param activation_checkpoint: If true, recompute the activations of
+            each transformer block in the backward pass instead of storing
+            them.
+        :param kv_heads: Nr. of key/value heads, shared by groups of query
+            heads (grouped-query attention). Defaults to heads.
         """
         super().__init__()
 
@@ -180,6 +276,10 @@ class TSTransformer(nn.Module):
         self.pos_embedding = nn.Embedding(
             embedding_dim=feature_dim, num_embeddings=seq_length
         )
+        # position indices, so they aren't recreated every forward pass
+        self.register_buffer(
+            "pos_ids", torch.arange(seq_length), persistent=False
+        )
 
         tblocks = []
         for i in range(depth):
@@ -190,18 +290,32 @@ class TSTransformer(nn.Module):
                     seq_length=seq_length,
                     mask=True,
                     dropout=dropout,
+                    kv_heads=kv_heads,
                 )
             )
 
-        self.tblocks = nn.Sequential(*tblocks)
+        self.tblocks = TransformerStack(
+            tblocks, checkpoint=activation_checkpoint
+        )
+        if compile:
+            # in place, so parameter names in the state dict are unchanged
+            self.tblocks.compile(fullgraph=True)
+        self.autocast_dtype = autocast_dtype
+
+        # the blocks are pre-norm, so normalize the output of the last one
+        self.norm = nn.LayerNorm(feature_dim)
 
         self.toprobs = nn.Linear(feature_dim, num_classes)
 
-        self.do = nn.Dropout(dropout)
+        # skip the dropout kernel entirely when it would be a no-op
+        self.do = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
 
-    def forward(self, x):
+    def forward(self, x, logits=False):
         """
         :param x: A batch by sequence length integer tensor of token indices.
+        :param logits: If true, return the unnormalized logits instead. Use
+            this with F.cross_entropy for training, which fuses the
+            log-softmax into the loss.
         :return: predicted log-probability vectors for each token based on the
         preceding tokens.
         """
@@ -209,20 +323,24 @@ class TSTransformer(nn.Module):
         # b, t, e = tokens.size()
         b, t, e = x.shape
 
-        positions = self.pos_embedding(torch.arange(t, device=d()))[
-            None, :, :
-        ].expand(b, t, e)
+        # (1, t, e), broadcast over the batch in the addition below
+        positions = self.pos_embedding(self.pos_ids[:t])[None, :, :]
         x = x + positions
         x = self.do(x)
 
-        x = self.tblocks(x)
+        with autocast(x, self.autocast_dtype):
+            x = self.norm(self.tblocks(x))
+        x = x.to(self.toprobs.weight.dtype)
 
         x = (
-            x.max(dim=1)[0] if self.max_pool else x.mean(dim=1)
+            x.amax(dim=1) if self.max_pool else x.mean(dim=1)
         )  # pool over the time dimension
 
         x = self.toprobs(x)
 
+        if logits:
+            return x
+
         return F.log_softmax(x, dim=1)
 
 
@@ -243,6 +361,10 @@ class TSRegTransformer(nn.Module):
         out_dim: int,
         max_pool: bool = True,
         dropout: float = 0.0,
+        compile: bool = False,
+        autocast_dtype: torch.dtype = None,
+        activation_checkpoint: bool = False,
+        kv_heads: int = None,
     ):
         """
         A time series transfomrmer that can handle both numerical and
@@ -257,6 +379,16 @@ class TSRegTransformer(nn.Module):
         :param max_pool: If true, use global max pooling in the last layer.
             If false, use global
                          average pooling.
+        :param compile: If true, compile the transformer blocks with
+            torch.compile.
+        :param autocast_dtype: If given (e.g. torch.bfloat16), run the
+            transformer blocks under autocast in this dtype. Pooling and the
+            output layer always run in full precision.
+        :param activation_checkpoint: If true, recompute the activations of
+            each transformer block in the backward pass instead of storing
+            them.
+        :param kv_heads: Nr. of key/value heads, shared by groups of query
+            heads (grouped-query attention). Defaults to heads.
         """
         super().__init__()
 
@@ -271,6 +403,10 @@ class TSRegTransformer(nn.Module):
         self.pos_embedding = nn.Embedding(
             embedding_dim=feature_dim, num_embeddings=seq_length
         )
+        # position indices, so they aren't recreated every forward pass
+        self.register_buffer(
+            "pos_ids", torch.arange(seq_length), persistent=False
+        )
 
         tblocks = []
         for i in range(depth):
@@ -281,14 +417,25 @@ class TSRegTransformer(nn.Module):
                     seq_length=seq_length,
                     mask=True,
                     dropout=dropout,
+                    kv_heads=kv_heads,
                 )
             )
 
-        self.tblocks = nn.Sequential(*tblocks)
+        self.tblocks = TransformerStack(
+            tblocks, checkpoint=activation_checkpoint
+        )
+        if compile:
+            # in place, so parameter names in the state dict are unchanged
+            self.tblocks.compile(fullgraph=True)
+        self.autocast_dtype = autocast_dtype
+
+        # the blocks are pre-norm, so normalize the output of the last one
+        self.norm = nn.LayerNorm(feature_dim)
 
         self.linear_output = nn.Linear(feature_dim, out_dim)
 
-        self.do = nn.Dropout(dropout)
+        # skip the dropout kernel entirely when it would be a no-op
+        self.do = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
 
     def forward(self, x):
         """
@@ -300,17 +447,19 @@ class TSRegTransformer(nn.Module):
         # b, t, e = tokens.size()
         b, t, e = x.shape
 
-        # place positional encoding onto the same device
-        positions = self.pos_embedding(torch.arange(t, device=x.device))[
-            None, :, :
-        ].expand(b, t, e)
-        x = x.float() + positions
+        # (1, t, e), broadcast over the batch in the addition below
+        positions = self.pos_embedding(self.pos_ids[:t])[None, :, :]
+        # match the model's dtype rather than forcing float32 (no-op if the
+        # input already has this dtype)
+        x = x.to(positions.dtype) + positions
         x = self.do(x)
 
-        x = self.tblocks(x)
+        with autocast(x, self.autocast_dtype):
+            x = self.norm(self.tblocks(x))
+        x = x.to(self.linear_output.weight.dtype)
 
         x = (
-            x.max(dim=1)[0] if self.max_pool else x.mean(dim=1)
+            x.amax(dim=1) if self.max_pool else x.mean(dim=1)
         )  # pool over the time dimension
 
         x = self.linear_output(x)
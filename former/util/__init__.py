@@ -1 +1 @@
-from .util import mask_, d, here, contains_nan
+from .util import mask_, d, autocast, aot_compile, here, contains_nan
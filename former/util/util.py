@@ -30,6 +30,75 @@ def d(tensor=None):
     return "cuda" if tensor.is_cuda else "cpu"
 
 
+def autocast(tensor, dtype=None):
+    """
+    Returns an autocast context manager for the device the given tensor is on.
+    Autocasting is disabled if dtype is None.
+
+    :param tensor:
+    :param dtype: The low precision dtype to run in (e.g. torch.bfloat16)
+    :return:
+    """
+    return torch.autocast(
+        tensor.device.type, dtype=dtype, enabled=dtype is not None
+    )
+
+
+def aot_compile(model, x, package_path=None):
+    """
+    Compiles a model ahead of time for inference, with torch.export and
+    AOTInductor. The result runs without the python/autograd overhead of the
+    original module. The batch size and sequence length stay dynamic, the
+    latter up to the model's seq_length.
+
+    :param model: One of the former transformers. It's exported in eval mode,
+        and its training mode is restored afterwards.
+    :param x: An example input batch (token indices, or features for the
+        time series models).
+    :param package_path: Where to write the compiled package. Defaults to a
+        file in the inductor cache directory.
+    :return: The compiled model, a callable taking an input batch like x.
+    """
+    import torch._inductor
+    import torch.export
+
+    seq_length = model.pos_ids.size(0)
+
+    b = torch.export.Dim("b", min=1)
+    t = torch.export.Dim("t", min=1, max=seq_length)
+
+    training = model.training
+    model.eval()
+    try:
+        program = torch.export.export(
+            model, (x,), dynamic_shapes=({0: b, 1: t},)
+        )
+    finally:
+        model.train(training)
+
+    path = torch._inductor.aoti_compile_and_package(
+        program, package_path=package_path
+    )
+    compiled = torch._inductor.aoti_load_package(path)
+
+    def run(input):
+        # the compiled kernels don't check their input, so do it here
+        assert (
+            input.dim() == x.dim() and input.shape[2:] == x.shape[2:]
+        ), f"Input has size {tuple(input.size())}, expected (b, t) + {tuple(x.shape[2:])}"
+        assert (
+            1 <= input.size(1) <= seq_length
+        ), f"Sequence length ({input.size(1)}) should be between 1 and seq_length ({seq_length})"
+        assert (
+            input.dtype == x.dtype
+        ), f"Input has dtype {input.dtype}, expected {x.dtype}"
+
+        # - the kernels assume contiguous memory (a no-op if it already is)
+        return compiled(input.contiguous())
+
+    return run
+
+
 def here(subpath=None):
     """
     :return: the path in which the package resides (the directory containing the 'former' dir)
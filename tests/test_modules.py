@@ -0,0 +1,77 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from _context import former
+
+from former import GTransformer
+from former.modules import SelfAttention
+
+
+def reference_attention(att, x):
+    """
+    Plain masked self-attention, computed without SDPA or the key/value cache.
+    """
+    b, t, e = x.size()
+    h, k, s = att.heads, att.kv_heads, att.head_dim
+
+    qkv = att.toqkv(x)
+    queries = qkv[..., :e].view(b, t, h, s).transpose(1, 2)
+    keys, values = qkv[..., e:].view(b, t, 2, k, s).permute(2, 0, 3, 1, 4)
+    keys = keys.repeat_interleave(h // k, dim=1)
+    values = values.repeat_interleave(h // k, dim=1)
+
+    dot = queries @ keys.transpose(-2, -1) / s ** 0.5
+    if att.mask:
+        mask = torch.ones(t, t, dtype=torch.bool).triu(diagonal=1)
+        dot = dot.masked_fill(mask, float("-inf"))
+
+    out = F.softmax(dot, dim=-1) @ values
+    return att.unifyheads(out.transpose(1, 2).reshape(b, t, e))
+
+
+@pytest.mark.parametrize("kv_heads", [None, 2, 1])
+@pytest.mark.parametrize("mask", [True, False])
+def test_attention_matches_reference(kv_heads, mask):
+    torch.manual_seed(0)
+    att = SelfAttention(32, heads=4, mask=mask, kv_heads=kv_heads)
+    x = torch.randn(2, 9, 32)
+
+    assert torch.allclose(att(x), reference_attention(att, x), atol=1e-5)
+
+
+@pytest.mark.parametrize("kv_heads", [None, 2])
+def test_cached_generation_matches_full_forward(kv_heads):
+    torch.manual_seed(0)
+    model = GTransformer(
+        emb=32,
+        heads=4,
+        depth=2,
+        seq_length=16,
+        num_tokens=50,
+        kv_heads=kv_heads,
+    ).eval()
+    x = torch.randint(0, 50, (2, 16))
+
+    with torch.no_grad():
+        full = model(x)
+
+        # prefill, several tokens after a cache, a single token, the rest
+        outputs, kvs = [], None
+        for fr, to in [(0, 5), (5, 9), (9, 10), (10, 16)]:
+            out, kvs = model(x[:, fr:to], past_kvs=kvs, use_cache=True)
+            outputs.append(out)
+
+    assert kvs[0][0].size(2) == 16
+    assert torch.allclose(torch.cat(outputs, dim=1), full, atol=1e-5)
+
+
+def test_cache_longer_than_seq_length():
+    model = GTransformer(
+        emb=32, heads=4, depth=1, seq_length=8, num_tokens=50
+    ).eval()
+    x = torch.randint(0, 50, (1, 6))
+
+    with torch.no_grad():
+        _, kvs = model(x, use_cache=True)
+        with pytest.raises(AssertionError, match="exceeds seq_length"):
+            model(torch.randint(0, 50, (1, 3)), past_kvs=kvs)
@@ -0,0 +1,35 @@
+import pytest
+import torch
+from _context import former
+
+from former import util, CTransformer
+
+
+def test_aot_compile(tmp_path):
+    torch.manual_seed(0)
+    model = CTransformer(
+        emb=32,
+        heads=4,
+        depth=1,
+        seq_length=16,
+        num_tokens=50,
+        num_classes=3,
+        dropout=0.1,
+    )
+
+    compiled = util.aot_compile(
+        model,
+        torch.randint(0, 50, (2, 9)),
+        package_path=str(tmp_path / "model.pt2"),
+    )
+    assert model.training
+
+    model.eval()
+    x = torch.randint(0, 50, (4, 12))
+    with torch.no_grad():
+        # - other batch sizes and sequence lengths, and a strided slice
+        for input in (x, x[:1], x[:, 2:7]):
+            assert torch.allclose(compiled(input), model(input), atol=1e-5)
+
+    with pytest.raises(AssertionError, match="seq_length"):
+        compiled(torch.randint(0, 50, (2, 17)))